@@ -215,7 +215,10 @@ class AbstractDiscreteAllocMemory(BaseAddressSpace):
 
         position = addr
         remaining = length
-        buff = ""
+        # Collect the pieces and join them once at the end, rather than
+        # copying the buffer read so far each time a page is appended
+        buff = []
+        buff_len = 0
         read = self.base.zread if pad else self.base.read
 
         # For each allocation...
@@ -228,7 +231,8 @@ class AbstractDiscreteAllocMemory(BaseAddressSpace):
             if paddr is None:
                 if not pad:
                     return None
-                buff += "\x00" * datalen
+                buff.append("\x00" * datalen)
+                buff_len += datalen
             else:
                 # This accounts for a special edge case
                 # when the address is valid in this address space
@@ -244,12 +248,13 @@ class AbstractDiscreteAllocMemory(BaseAddressSpace):
                     if not pad:
                         return obj.NoneObject("Could not read_chunks from addr " + hex(position) + " of size " + hex(datalen))
                     data = "\x00" * datalen
-                buff += data
+                buff.append(data)
+                buff_len += len(data)
             position += datalen
             remaining -= datalen
             assert (addr + length == position + remaining), "Address + length != position + remaining (" + hex(addr + length) + " != " + hex(position + remaining) + ") in " + self.base.__class__.__name__
-            assert (position - addr == len(buff)), "Position - address != len(buff) (" + str(position - addr) + " != " + str(len(buff)) + ") in " + self.base.__class__.__name__
-        return buff
+            assert (position - addr == buff_len), "Position - address != len(buff) (" + str(position - addr) + " != " + str(buff_len) + ") in " + self.base.__class__.__name__
+        return "".join(buff)
 
     def read(self, addr, length):
         '''
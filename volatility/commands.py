@@ -201,8 +201,8 @@ class Command(object):
             outfd.write(self.tablesep.join(titles) + "\n")
             outfd.write(self.tablesep.join(rules) + "\n")
 
-    def table_row(self, outfd, *args):
-        """Outputs a single row of a table"""
+    def format_row(self, *args):
+        """Formats a single row of a table using the current table header"""
         reslist = []
         if len(args) > len(self._formatlist):
             debug.error("Too many values for the table")
@@ -210,4 +210,8 @@ class Command(object):
             spec = self._formatlist[index]
             result = self._elide(("{0:" + spec.to_string() + "}").format(args[index]), spec.minwidth)
             reslist.append(result)
-        outfd.write(self.tablesep.join(reslist) + "\n")
+        return self.tablesep.join(reslist) + "\n"
+
+    def table_row(self, outfd, *args):
+        """Outputs a single row of a table"""
+        outfd.write(self.format_row(*args))
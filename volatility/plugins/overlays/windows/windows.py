@@ -657,22 +657,37 @@ class _MMVAD_SHORT(obj.CType):
 
         We try to be tolerant of cycles by storing all offsets visited.
         """
+        for vad, _level in self.traverse_levels(visited = visited):
+            yield vad
+
+    def traverse_levels(self, visited = None):
+        """ Traverse the VAD tree like traverse(), but generate
+        (vad, level) tuples where level is the depth of the node
+        below the one the walk started from (which is level 0).
+
+        The walk uses an explicit stack rather than recursing into
+        each child, so a node is yielded straight to the caller instead
+        of being passed back up through one generator per tree level.
+        """
         if visited == None:
             visited = set()
 
-        ## We try to prevent loops here
-        if self.obj_offset in visited:
-            return
+        stack = [(self, 0)]
+        while stack:
+            vad, level = stack.pop()
 
-        yield self
+            ## We try to prevent loops here
+            if vad.obj_offset in visited:
+                continue
+            visited.add(vad.obj_offset)
 
-        for c in self.LeftChild.traverse(visited = visited):
-            visited.add(c.obj_offset)
-            yield c
+            yield vad, level
 
-        for c in self.RightChild.traverse(visited = visited):
-            visited.add(c.obj_offset)
-            yield c
+            # Push the right child first so the left subtree is
+            # walked before it
+            for child in (vad.RightChild.dereference(), vad.LeftChild.dereference()):
+                if child:
+                    stack.append((child, level + 1))
 
     @property
     def Parent(self):
@@ -26,13 +26,15 @@
 # "The VAD Tree: A Process-Eye View of Physical Memory," Brendan Dolan-Gavitt
 
 import os.path
+import cStringIO
+import collections
+import volatility.addrspace as addrspace
 import volatility.plugins.taskmods as taskmods
 import volatility.debug as debug #pylint: disable-msg=W0611
-import volatility.constants as constants
 
 # Vad Protections. Also known as page protections. _MMVAD_FLAGS.Protection,
 # 3-bits, is an index into nt!MmProtectToValue (the following list). 
-PROTECT_FLAGS = dict(enumerate([
+_PROTECT_FLAGS = (
     'PAGE_NOACCESS',
     'PAGE_READONLY',
     'PAGE_EXECUTE',
@@ -65,13 +67,17 @@ PROTECT_FLAGS = dict(enumerate([
     'PAGE_WRITECOMBINE | PAGE_WRITECOPY',
     'PAGE_WRITECOMBINE | PAGE_EXECUTE_READWRITE',
     'PAGE_WRITECOMBINE | PAGE_EXECUTE_WRITECOPY',
-]))
+)
+
+# The tuple is indexed directly by the vad plugins; other plugins
+# (e.g. malfind) use the dict form with .get()
+PROTECT_FLAGS = dict(enumerate(_PROTECT_FLAGS))
 
 # Vad Types. The _MMVAD_SHORT.u.VadFlags (_MMVAD_FLAGS) struct on XP has  
 # individual flags, 1-bit each, for these types. The _MMVAD_FLAGS for all
 # OS after XP has a member _MMVAD_FLAGS.VadType, 3-bits, which is an index
 # into the following enumeration. 
-MI_VAD_TYPE = dict(enumerate([
+_MI_VAD_TYPE = (
     'VadNone',
     'VadDevicePhysicalMemory',
     'VadImageMap',
@@ -80,34 +86,88 @@ MI_VAD_TYPE = dict(enumerate([
     'VadLargePages',
     'VadRotatePhysical',
     'VadLargePageSection',
-]))
+)
+
+MI_VAD_TYPE = dict(enumerate(_MI_VAD_TYPE))
+
+# Separators written ahead of each process's output
+_BANNER = "*" * 72 + "\n"
+_BANNER_SLASH = "/" + "*" * 72 + "/\n"
+
+# Per-VAD output templates. Each block is formatted with a single call
+# and the bound format methods save an attribute lookup per VAD.
+_VAD_FLAGS_FMT = ("Flags: {0}\n"
+                  "Protection: {1}\n").format
+
+_VAD_TYPE_FMT = "Vad Type: {0}\n".format
+
+_CONTROL_AREA_FMT = ("ControlArea @{0:08x} Segment {1:08x}\n"
+                     "Dereference list: Flink {2:08x}, Blink {3:08x}\n"
+                     "NumberOfSectionReferences: {4:10} NumberOfPfnReferences:  {5:10}\n"
+                     "NumberOfMappedViews:       {6:10} NumberOfUserReferences: {7:10}\n"
+                     "WaitingForDeletion Event:  {8:08x}\n"
+                     "Control Flags: {9}\n").format
+
+_FILE_OBJECT_FMT = "FileObject @{0:08x}, Name: {1}\n".format
+
+_VAD_EXT_FMT = ("First prototype PTE: {0:08x} Last contiguous PTE: {1:08x}\n"
+                "Flags2: {2}\n").format
+
+_DOT_NODE_FMT = ("vad_{0:08x} -> vad_{1:08x}\n"
+                 "vad_{1:08x} [label = \"{{ {2}\\n{3:08x} - {4:08x} }}\""
+                 "shape = \"record\" color = \"blue\"];\n").format
+
+# A VAD node with the values the vad plugins print already read, so
+# each node is only dereferenced once per walk. parent, left and right
+# are the offsets of the linked nodes (0 if there is none) and are only
+# filled in when asked for, since each one instantiates another node.
+# level is the node's depth in the tree, the root being level 0.
+VadRow = collections.namedtuple("VadRow",
+    "obj_offset start end parent left right level tag flags vad")
+
+# Maps the raw bytes of a VAD tag to its string form. Only the few
+# tags known to the _MMVAD factory ever reach the vad plugins, so this
+# stays tiny and lets every node with the same tag share one string.
+_TAG_CACHE = {}
 
 # Inherit from dlllist just for the config options (__init__)
 class VADInfo(taskmods.DllList):
     """Dump the VAD info"""
 
+    def _iter_vads(self, task, links = False):
+        """Walk a process's VAD tree once and yield a VadRow
+        for each valid node.
+
+        @param task: an _EPROCESS object
+        @param links: resolve the parent and child node offsets
+        as well (they are None otherwise)
+        """
+        for vad, level in task.VadRoot.traverse_levels():
+            # Ignore Vads with bad tags
+            if not vad:
+                continue
+
+            if links:
+                parent = vad.Parent.obj_offset or 0
+                left = vad.LeftChild.dereference().obj_offset or 0
+                right = vad.RightChild.dereference().obj_offset or 0
+            else:
+                parent = left = right = None
+
+            raw_tag = vad.Tag.v()
+            tag = _TAG_CACHE.get(raw_tag)
+            if tag is None:
+                tag = str(vad.Tag)
+                if raw_tag:
+                    _TAG_CACHE[raw_tag] = tag
+
+            yield VadRow(vad.obj_offset, vad.Start, vad.End,
+                         parent, left, right, level,
+                         tag, vad.u.VadFlags, vad)
+
     def render_text(self, outfd, data):
-        for task in data:
-            outfd.write("*" * 72 + "\n")
-            outfd.write("Pid: {0:6}\n".format(task.UniqueProcessId))
-            for vad in task.VadRoot.traverse():
-                if vad == None:
-                    outfd.write("Error: {0}".format(vad))
-                else:
-                    self.write_vad_short(outfd, vad)
-                    try:
-                        self.write_vad_control(outfd, vad)
-                    except AttributeError:
-                        pass
-                    try:
-                        self.write_vad_ext(outfd, vad)
-                    except AttributeError:
-                        pass
-
-                outfd.write("\n")
-
-    def write_vad_short(self, outfd, vad):
-        """Renders a text version of a Short Vad"""
+        # The VAD header line uses the same layout for every node,
+        # so only set it up once rather than per VAD
         self.table_header(None,
                           [("VAD node @", str(len("VAD node @"))),
                            ("address", "[addrpad]"),
@@ -118,125 +178,189 @@ class VADInfo(taskmods.DllList):
                            ("Tag", "3"),
                            ("tagval", ""),
                            ])
-        self.table_row(outfd, "VAD node @",
-                              vad.obj_offset,
-                              "Start",
-                              vad.Start,
-                              "End",
-                              vad.End,
-                              "Tag",
-                              vad.Tag)
-        outfd.write("Flags: {0}\n".format(str(vad.u.VadFlags)))
+        for task in data:
+            # Collect each process's output in memory and hand it to
+            # outfd in one write, instead of several small writes per VAD
+            buf = cStringIO.StringIO()
+            try:
+                buf.write(_BANNER)
+                buf.write("Pid: {0:6}\n".format(task.UniqueProcessId))
+                for row in self._iter_vads(task):
+                    # Gather all the lines for this VAD and write them at once
+                    parts = self.write_vad_short(row)
+                    # Only long VADs have the control area and extended
+                    # fields, so pick the writers from the VAD's type
+                    if row.vad.obj_type != "_MMVAD_SHORT":
+                        # even if the ControlArea is not NULL, it is only meaningful
+                        # for shared (non private) memory sections, so don't
+                        # bother looking for it in private ones
+                        if row.flags.PrivateMemory != 1:
+                            parts += self.write_vad_control(row)
+                        parts += self.write_vad_ext(row)
+                    parts.append("\n")
+                    buf.write("".join(parts))
+            finally:
+                outfd.write(buf.getvalue())
+
+    def write_vad_short(self, row):
+        """Renders a text version of a Short Vad
+
+        @param row: a VadRow
+        @returns: a list of output lines. The VAD node table
+        header must already have been set up (see render_text).
+        """
+        # Each member access walks the profile, so look them up once
+        flags = row.flags
+        protection = flags.Protection.v()
+        parts = [self.format_row("VAD node @",
+                                 row.obj_offset,
+                                 "Start",
+                                 row.start,
+                                 "End",
+                                 row.end,
+                                 "Tag",
+                                 row.tag)]
         # although the numeric value of Protection is printed above with VadFlags,
         # let's show the user a human-readable translation of the protection 
-        outfd.write("Protection: {0}\n".format(PROTECT_FLAGS.get(vad.u.VadFlags.Protection.v(), hex(vad.u.VadFlags.Protection))))
+        parts.append(_VAD_FLAGS_FMT(str(flags),
+                                    _PROTECT_FLAGS[protection] if protection < len(_PROTECT_FLAGS) else hex(protection)))
         # translate the vad type if its available (> XP)
-        if hasattr(vad.u.VadFlags, "VadType"):
-            outfd.write("Vad Type: {0}\n".format(MI_VAD_TYPE.get(vad.u.VadFlags.VadType.v(), hex(vad.u.VadFlags.VadType))))
+        if hasattr(flags, "VadType"):
+            vad_type = flags.VadType.v()
+            parts.append(_VAD_TYPE_FMT(_MI_VAD_TYPE[vad_type] if vad_type < len(_MI_VAD_TYPE) else hex(vad_type)))
+        return parts
 
-    def write_vad_control(self, outfd, vad):
-        """Renders a text version of a (non-short) Vad's control information"""
+    def write_vad_control(self, row):
+        """Renders a text version of a (non-short) Vad's control information
 
-        # even if the ControlArea is not NULL, it is only meaningful 
-        # for shared (non private) memory sections. 
-        if vad.u.VadFlags.PrivateMemory == 1:
-            return
+        The caller is expected to skip private memory VADs, for
+        which the ControlArea has no meaning.
 
-        control_area = vad.ControlArea
+        @param row: a VadRow
+        @returns: a list of output lines
+        """
+        control_area = row.vad.ControlArea
         if not control_area:
-            return
+            return []
+
+        # Every member access through the pointer dereferences it
+        # again, so dereference once and work from the structure
+        ca = control_area.dereference()
+        dereference_list = ca.DereferenceList
 
-        outfd.write("ControlArea @{0:08x} Segment {1:08x}\n".format(control_area.dereference().obj_offset, control_area.Segment))
-        outfd.write("Dereference list: Flink {0:08x}, Blink {1:08x}\n".format(control_area.DereferenceList.Flink, control_area.DereferenceList.Blink))
-        outfd.write("NumberOfSectionReferences: {0:10} NumberOfPfnReferences:  {1:10}\n".format(control_area.NumberOfSectionReferences, control_area.NumberOfPfnReferences))
-        outfd.write("NumberOfMappedViews:       {0:10} NumberOfUserReferences: {1:10}\n".format(control_area.NumberOfMappedViews, control_area.NumberOfUserReferences))
-        outfd.write("WaitingForDeletion Event:  {0:08x}\n".format(control_area.WaitingForDeletion))
-        outfd.write("Control Flags: {0}\n".format(str(control_area.u.Flags)))
+        parts = [_CONTROL_AREA_FMT(ca.obj_offset, ca.Segment,
+                                   dereference_list.Flink, dereference_list.Blink,
+                                   ca.NumberOfSectionReferences, ca.NumberOfPfnReferences,
+                                   ca.NumberOfMappedViews, ca.NumberOfUserReferences,
+                                   ca.WaitingForDeletion,
+                                   str(ca.u.Flags))]
 
-        file_object = vad.FileObject
+        # vad.FileObject would walk from the vad to the control area
+        # again. dereference_as covers both the plain FilePointer and
+        # the _EX_FAST_REF used from Vista on.
+        file_object = ca.FilePointer.dereference_as("_FILE_OBJECT")
 
         if file_object:
-            outfd.write("FileObject @{0:08x}, Name: {1}\n".format(file_object.obj_offset, str(file_object.FileName or '')))
+            parts.append(_FILE_OBJECT_FMT(file_object.obj_offset, str(file_object.FileName or '')))
 
-    def write_vad_ext(self, outfd, vad):
-        """Renders a text version of a Long Vad"""
-        outfd.write("First prototype PTE: {0:08x} Last contiguous PTE: {1:08x}\n".format(vad.FirstPrototypePte, vad.LastContiguousPte))
-        outfd.write("Flags2: {0}\n".format(str(vad.u2.VadFlags2)))
+        return parts
+
+    def write_vad_ext(self, row):
+        """Renders a text version of a Long Vad
+
+        @param row: a VadRow
+        @returns: a list of output lines
+        """
+        vad = row.vad
+        return [_VAD_EXT_FMT(vad.FirstPrototypePte, vad.LastContiguousPte, str(vad.u2.VadFlags2))]
 
 class VADTree(VADInfo):
     """Walk the VAD tree and display in tree format"""
 
     def render_text(self, outfd, data):
         for task in data:
-            outfd.write("*" * 72 + "\n")
-            outfd.write("Pid: {0:6}\n".format(task.UniqueProcessId))
-            levels = {}
-            self.table_header(None,
-                              [("indent", ""),
-                               ("Start", "[addrpad]"),
-                               ("-", "1"),
-                               ("End", "[addrpad]")
-                              ])
-            for vad in task.VadRoot.traverse():
-                if vad:
-                    level = levels.get(vad.Parent.obj_offset, -1) + 1
-                    levels[vad.obj_offset] = level
-                    self.table_row(outfd,
-                                   " " * level,
-                                   vad.Start,
+            buf = cStringIO.StringIO()
+            try:
+                buf.write(_BANNER)
+                buf.write("Pid: {0:6}\n".format(task.UniqueProcessId))
+                self.table_header(None,
+                                  [("indent", ""),
+                                   ("Start", "[addrpad]"),
+                                   ("-", "1"),
+                                   ("End", "[addrpad]")
+                                  ])
+                for row in self._iter_vads(task):
+                    self.table_row(buf,
+                                   " " * row.level,
+                                   row.start,
                                    "-",
-                                   vad.End)
+                                   row.end)
+            finally:
+                outfd.write(buf.getvalue())
 
     def render_dot(self, outfd, data):
         for task in data:
-            outfd.write("/" + "*" * 72 + "/\n")
-            outfd.write("/* Pid: {0:6} */\n".format(task.UniqueProcessId))
-            outfd.write("digraph processtree {\n")
-            outfd.write("graph [rankdir = \"TB\"];\n")
-            for vad in task.VadRoot.traverse():
-                if vad:
-                    if vad.Parent:
-                        outfd.write("vad_{0:08x} -> vad_{1:08x}\n".format(vad.Parent.obj_offset or 0, vad.obj_offset))
-                        outfd.write("vad_{0:08x} [label = \"{{ {1}\\n{2:08x} - {3:08x} }}\""
-                                "shape = \"record\" color = \"blue\"];\n".format(
-                        vad.obj_offset,
-                        vad.Tag,
-                        vad.Start,
-                        vad.End))
-
-            outfd.write("}\n")
+            buf = cStringIO.StringIO()
+            try:
+                buf.write(_BANNER_SLASH)
+                buf.write("/* Pid: {0:6} */\n".format(task.UniqueProcessId))
+                buf.write("digraph processtree {\n")
+                buf.write("graph [rankdir = \"TB\"];\n")
+                for row in self._iter_vads(task, links = True):
+                    # row.parent is 0 when the node has no valid parent,
+                    # so there is no need to instantiate the Parent again
+                    if row.parent:
+                        buf.write(_DOT_NODE_FMT(row.parent,
+                                                row.obj_offset,
+                                                row.tag,
+                                                row.start,
+                                                row.end))
+
+                buf.write("}\n")
+            finally:
+                outfd.write(buf.getvalue())
 
 class VADWalk(VADInfo):
     """Walk the VAD tree"""
 
     def render_text(self, outfd, data):
         for task in data:
-            outfd.write("*" * 72 + "\n")
-            outfd.write("Pid: {0:6}\n".format(task.UniqueProcessId))
-            self.table_header(outfd,
-                              [("Address", "[addrpad]"),
-                               ("Parent", "[addrpad]"),
-                               ("Left", "[addrpad]"),
-                               ("Right", "[addrpad]"),
-                               ("Start", "[addrpad]"),
-                               ("End", "[addrpad]"),
-                               ("Tag", "4"),
-                               ])
-            for vad in task.VadRoot.traverse():
-                # Ignore Vads with bad tags (which we explicitly include as None)
-                if vad:
-                    self.table_row(outfd,
-                        vad.obj_offset,
-                        vad.Parent.obj_offset or 0,
-                        vad.LeftChild.dereference().obj_offset or 0,
-                        vad.RightChild.dereference().obj_offset or 0,
-                        vad.Start,
-                        vad.End,
-                        vad.Tag)
+            buf = cStringIO.StringIO()
+            try:
+                buf.write(_BANNER)
+                buf.write("Pid: {0:6}\n".format(task.UniqueProcessId))
+                self.table_header(buf,
+                                  [("Address", "[addrpad]"),
+                                   ("Parent", "[addrpad]"),
+                                   ("Left", "[addrpad]"),
+                                   ("Right", "[addrpad]"),
+                                   ("Start", "[addrpad]"),
+                                   ("End", "[addrpad]"),
+                                   ("Tag", "4"),
+                                   ])
+                for row in self._iter_vads(task, links = True):
+                    self.table_row(buf,
+                        row.obj_offset,
+                        row.parent,
+                        row.left,
+                        row.right,
+                        row.start,
+                        row.end,
+                        row.tag)
+            finally:
+                outfd.write(buf.getvalue())
 
 class VADDump(VADInfo):
     """Dumps out the vad sections to a file"""
 
+    # Size of the chunks read from the process AS and written to
+    # the output file by dump_vad. Kept small so that dumping a
+    # large vad only ever holds one chunk in memory.
+    DUMP_BLOCKSIZE = 1024 * 1024
+
+    # Granularity at which dump_vad checks for pages that are present
+    PAGE_SIZE = 0x1000
+
     def __init__(self, config, *args, **kwargs):
         VADInfo.__init__(self, config, *args, **kwargs)
         config.add_option('DUMP-DIR', short_option = 'D', default = None,
@@ -259,29 +383,113 @@ class VADDump(VADInfo):
         a file, rather than building a large buffer in 
         memory and then flushing it at once. This prevents
         our own analysis process from consuming massive
-        amounts of memory for large vads. 
+        amounts of memory for large vads. Pages that are
+        not present are skipped and left as holes in the
+        (sparse) file, which reads back as zeros just like
+        zread's padding.
 
         @returns path to the image file on success or
         an error message stating why the file could not
         be dumped. 
         """
 
-        fh = open(path, "wb")
-        if fh:
-            offset = vad.Start
-            out_of_range = vad.Start + vad.Length 
-            while offset < out_of_range:
-                to_read = min(constants.SCAN_BLOCKSIZE, out_of_range - offset)
-                data = address_space.zread(offset, to_read)
-                if not data: 
-                    break
-                fh.write(data)
-                offset += to_read
-            fh.close()
-            return path
-        else:
+        # The chunks are already large, so write them straight to the
+        # file descriptor rather than copying them through a file buffer
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                         getattr(os, "O_BINARY", 0), 0644)
+        except OSError:
             return "Cannot open {0} for writing".format(path)
-        
+
+        try:
+            start = vad.Start
+            size = vad.Length
+            out_of_range = start + size
+            offset = start
+            # Offset (relative to the vad) the file has been written up to
+            file_end = 0
+            while offset < out_of_range:
+                # zread would only pad pages without a translation
+                # with zeros, so leave those as holes in the file and
+                # just read the runs of pages that are present
+                if address_space.vtop(offset) is None:
+                    offset += self.PAGE_SIZE
+                    continue
+                run_end = offset + self.PAGE_SIZE
+                while (run_end < out_of_range and
+                       run_end - offset < self.DUMP_BLOCKSIZE and
+                       address_space.vtop(run_end) is not None):
+                    run_end += self.PAGE_SIZE
+                run_end = min(run_end, out_of_range)
+
+                data = address_space.zread(offset, run_end - offset)
+                if offset - start != file_end:
+                    os.lseek(fd, offset - start, os.SEEK_SET)
+                # os.write may not take the whole chunk in one call
+                written = 0
+                while written < len(data):
+                    written += os.write(fd, data[written:])
+                file_end = offset - start + written
+                offset = run_end
+            # Seeking past the end doesn't extend the file, so a vad
+            # ending in absent pages needs its last byte written out
+            if file_end < size:
+                os.lseek(fd, size - 1, os.SEEK_SET)
+                os.write(fd, "\x00")
+            # Where supported, tell the OS we won't read the dumped data
+            # back, so it doesn't push more useful pages out of the cache
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+        return path
+
+    def _dump_one_task(self, outfd, task, addr_format):
+        """Dump all the vads of one process and write a table
+        row for each to outfd.
+
+        @param task: an _EPROCESS object
+        @param addr_format: format method for the addresses in
+        the file names (the [addrpad] table format)
+        """
+        # Walking the VAD tree can be done in kernel AS, but to 
+        # carve the actual data, we need a valid process AS. 
+        task_space = task.get_process_address_space()
+        if not task_space:
+            outfd.write("Unable to get process AS for {0}\n".format(task.UniqueProcessId))
+            return
+
+        offset = task_space.vtop(task.obj_offset)
+
+        for row in self._iter_vads(task):
+            vad = row.vad
+            if not vad.is_valid():
+                continue
+
+            if self._config.BASE and row.start != self._config.BASE:
+                continue
+
+            # Open the file and initialize the data
+
+            vad_start = addr_format(row.start)
+            vad_end = addr_format(row.end)
+
+            path = os.path.join(
+                self._config.DUMP_DIR, "{0}.{1:x}.{2}-{3}.dmp".format(
+                task.ImageFileName, offset, vad_start, vad_end))
+
+            if (task.IsWow64 and row.flags.CommitCharge == 0x7ffffffffffff and 
+                    row.end > 0x7fffffff):
+                result = "Skipping Wow64 MM_MAX_COMMIT range"
+            else:
+                result = self.dump_vad(path, vad, task_space)
+
+            self.table_row(outfd, 
+                           task.UniqueProcessId, 
+                           task.ImageFileName, 
+                           row.start, row.end, result)
+
     def render_text(self, outfd, data):
         if self._config.DUMP_DIR == None:
             debug.error("Please specify a dump directory (--dump-dir)")
@@ -296,39 +504,14 @@ class VADDump(VADInfo):
                            ("Result", ""),
                            ])
 
-        for task in data:
-            # Walking the VAD tree can be done in kernel AS, but to 
-            # carve the actual data, we need a valid process AS. 
-            task_space = task.get_process_address_space()
-            if not task_space:
-                outfd.write("Unable to get process AS for {0}\n".format(task.UniqueProcessId))
-                continue
-
-            offset = task_space.vtop(task.obj_offset)
-
-            for vad in task.VadRoot.traverse():
-                if not vad.is_valid():
-                    continue
-
-                if self._config.BASE and vad.Start != self._config.BASE:
-                    continue
-
-                # Open the file and initialize the data
-
-                vad_start = self.format_value(vad.Start, "[addrpad]")
-                vad_end = self.format_value(vad.End, "[addrpad]")
+        # format_value looks up the profile on every call, so resolve
+        # the address format once for all the file names
+        profile = addrspace.BufferAddressSpace(self._config).profile
+        addr_format = ("{0:" + self._formatlookup(profile, "[addrpad]") + "}").format
 
-                path = os.path.join(
-                    self._config.DUMP_DIR, "{0}.{1:x}.{2}-{3}.dmp".format(
-                    task.ImageFileName, offset, vad_start, vad_end))
-
-                if (task.IsWow64 and vad.u.VadFlags.CommitCharge == 0x7ffffffffffff and 
-                        vad.End > 0x7fffffff):
-                    result = "Skipping Wow64 MM_MAX_COMMIT range"
-                else:
-                    result = self.dump_vad(path, vad, task_space)
-
-                self.table_row(outfd, 
-                               task.UniqueProcessId, 
-                               task.ImageFileName, 
-                               vad.Start, vad.End, result)
+        for task in data:
+            buf = cStringIO.StringIO()
+            try:
+                self._dump_one_task(buf, task, addr_format)
+            finally:
+                outfd.write(buf.getvalue())